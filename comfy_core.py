@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import random
+import socket
+import mmap
+import mimetypes
+import uuid
+import asyncio
+import aiohttp
+import subprocess
+import requests
+from requests.adapters import HTTPAdapter
+import logging
+
+# Prefer the SIMD-accelerated encoder when available
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+
+# Prefer orjson for serializing the prompt body when available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("comfyui-handler")
+
+# Configuration
+COMFYUI_PORT = 8188
+COMFYUI_DIR = "/workspace/ComfyUI"
+INPUT_DIR = f"{COMFYUI_DIR}/input"
+OUTPUT_DIR = f"{COMFYUI_DIR}/output"
+STARTUP_TIMEOUT = 600
+# Exponential backoff between readiness checks, with +/-20% jitter
+STARTUP_RETRY_BASE_DELAY = 0.1
+STARTUP_RETRY_MAX_DELAY = 2.0
+PROCESSING_TIMEOUT = 600
+REQUEST_TIMEOUT = 60
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Fall back to INFO for unknown level names rather than failing in logging.basicConfig
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    LOG_LEVEL = "INFO"
+# Levels accepted by ComfyUI's --verbose option
+COMFYUI_LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+# Importing torch & co. just to log versions is slow, so only do it on request
+VERIFY_DEPS = os.getenv("VERIFY_DEPS", "").lower() in ("1", "true", "yes")
+
+# When the caller mounts the same volume as OUTPUT_DIR, return only the
+# output file path and let the caller read the file from the shared volume
+RETURN_PATH_ONLY = os.getenv("RETURN_PATH_ONLY", "").lower() in ("1", "true", "yes")
+
+# Optional S3/R2 bucket for outputs; falls back to base64 in the response when unset
+OUTPUT_S3_BUCKET = os.getenv("OUTPUT_S3_BUCKET")
+try:
+    OUTPUT_URL_EXPIRY = int(os.getenv("OUTPUT_URL_EXPIRY", "3600"))
+except ValueError:
+    logger.warning(f"Invalid OUTPUT_URL_EXPIRY {os.getenv('OUTPUT_URL_EXPIRY')!r}, using 3600 seconds")
+    OUTPUT_URL_EXPIRY = 3600
+S3_CLIENT = None
+if OUTPUT_S3_BUCKET:
+    # Only pay for importing boto3 when the bucket is actually used
+    import boto3
+    S3_CLIENT = boto3.client("s3", endpoint_url=os.getenv("OUTPUT_S3_ENDPOINT_URL"))
+
+# Reuse a single keep-alive connection pool for the startup readiness checks
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+
+# aiohttp session shared by all jobs, created lazily on the running event loop
+_CLIENT_SESSION = None
+_CLIENT_SESSION_LOOP = None
+
+# Check required dependencies
+def check_dependencies():
+    try:
+        import numpy
+        logger.info(f"NumPy version: {numpy.__version__}")
+        
+        import torch
+        logger.info(f"PyTorch version: {torch.__version__}")
+        logger.info(f"CUDA available: {torch.cuda.is_available()}")
+        if torch.cuda.is_available():
+            logger.info(f"CUDA version: {torch.version.cuda}")
+        
+        import torchaudio
+        logger.info(f"TorchAudio version: {torchaudio.__version__}")
+        
+        # Check FFmpeg
+        try:
+            import imageio_ffmpeg
+            logger.info(f"imageio-ffmpeg version: {imageio_ffmpeg.__version__}")
+            ffmpeg_path = imageio_ffmpeg.get_ffmpeg_exe()
+            logger.info(f"FFmpeg path: {ffmpeg_path}")
+        except ImportError:
+            logger.error("imageio-ffmpeg is not installed!")
+            raise
+        except Exception as e:
+            logger.error(f"Error checking FFmpeg: {str(e)}")
+            raise
+            
+    except ImportError as e:
+        logger.error(f"Missing required dependency: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error checking dependencies: {str(e)}")
+        raise
+
+# Start ComfyUI as a background process
+def start_comfyui():
+    logger.info("Starting ComfyUI server...")
+    try:
+        # Check dependencies first
+        if VERIFY_DEPS:
+            check_dependencies()
+        else:
+            logger.info("Skipping dependency check (set VERIFY_DEPS=1 to enable)")
+        
+        process = subprocess.Popen(
+            ["python", "main.py", "--listen", "0.0.0.0", "--port", str(COMFYUI_PORT), "--cuda-device", "0"]
+            + (["--verbose", LOG_LEVEL] if LOG_LEVEL in COMFYUI_LOG_LEVELS else []),
+            cwd=COMFYUI_DIR,
+            # Inherit our stdout/stderr so ComfyUI logs go straight to the container log;
+            # ComfyUI filters its own logging through --verbose
+            stdout=None,
+            stderr=None
+        )
+        
+        return process
+    except Exception as e:
+        logger.error(f"Error starting ComfyUI: {str(e)}")
+        raise
+
+# Wait for ComfyUI to be ready
+def wait_for_comfyui():
+    logger.info(f"Waiting for ComfyUI server to be ready (max {STARTUP_TIMEOUT}s)...")
+    
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    retry = 0
+    while time.monotonic() < deadline:
+        try:
+            # Cheap TCP probe before issuing a full HTTP request
+            with socket.create_connection(("127.0.0.1", COMFYUI_PORT), timeout=0.2):
+                pass
+            
+            response = SESSION.get(f"http://127.0.0.1:{COMFYUI_PORT}/system_stats", timeout=REQUEST_TIMEOUT)
+            if response.status_code == 200:
+                logger.info("ComfyUI server is ready!")
+                return True
+            else:
+                logger.warning(f"ComfyUI returned status code {response.status_code}, retrying...")
+        except requests.exceptions.Timeout:
+            logger.warning(f"Timeout while checking ComfyUI status (attempt {retry+1})")
+        except (OSError, requests.exceptions.ConnectionError):
+            logger.info(f"Waiting for ComfyUI to start (attempt {retry+1})...")
+        except Exception as e:
+            logger.warning(f"Error checking ComfyUI status: {str(e)}")
+        
+        delay = min(STARTUP_RETRY_MAX_DELAY, STARTUP_RETRY_BASE_DELAY * 2 ** min(retry, 5))
+        time.sleep(delay * random.uniform(0.8, 1.2))
+        retry += 1
+    
+    raise Exception(f"ComfyUI server failed to start after {STARTUP_TIMEOUT} seconds")
+
+# Serialize a request body to JSON bytes
+def dumps_json(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+# Base64 encode a file straight from a read-only memory map, without copying it into a bytes object
+def encode_file_base64(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _b64.b64encode(mm).decode("ascii")
+
+# Decode a base64 image into ComfyUI's input directory and return its filename for LoadImage
+def stage_input_image(image_base64):
+    filename = f"{uuid.uuid4()}.png"
+    os.makedirs(INPUT_DIR, exist_ok=True)
+    with open(f"{INPUT_DIR}/{filename}", "wb") as f:
+        f.write(_b64.b64decode(image_base64))
+    return filename
+
+# Remove a staged input image once the workflow that used it has finished
+def remove_input_image(filename):
+    try:
+        os.remove(f"{INPUT_DIR}/{filename}")
+    except OSError as e:
+        logger.warning(f"Error removing input image {filename}: {str(e)}")
+
+# Upload an output file to the output bucket and return a presigned download URL
+def upload_output(path, key, content_type):
+    logger.info(f"Uploading {path} to s3://{OUTPUT_S3_BUCKET}/{key}")
+    S3_CLIENT.upload_file(path, OUTPUT_S3_BUCKET, key, ExtraArgs={"ContentType": content_type})
+    return S3_CLIENT.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": OUTPUT_S3_BUCKET, "Key": key},
+        ExpiresIn=OUTPUT_URL_EXPIRY
+    )
+
+# Return the shared aiohttp session, creating it if needed for the running event loop
+def get_client_session():
+    global _CLIENT_SESSION, _CLIENT_SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if _CLIENT_SESSION is None or _CLIENT_SESSION.closed or _CLIENT_SESSION_LOOP is not loop:
+        _CLIENT_SESSION = aiohttp.ClientSession()
+        _CLIENT_SESSION_LOOP = loop
+    return _CLIENT_SESSION
+
+# Close the shared aiohttp session, e.g. before the event loop that owns it exits
+async def close_client_session():
+    global _CLIENT_SESSION, _CLIENT_SESSION_LOOP
+    if _CLIENT_SESSION is not None and not _CLIENT_SESSION.closed:
+        await _CLIENT_SESSION.close()
+    _CLIENT_SESSION = None
+    _CLIENT_SESSION_LOOP = None
+
+# Wait for ComfyUI to report that the queued prompt has finished executing, collecting
+# the UI outputs each node reports along the way
+async def wait_for_execution(ws, execution_id):
+    outputs = {}
+    while True:
+        message = await ws.receive()
+        if message.type == aiohttp.WSMsgType.BINARY:
+            # Binary frames carry preview images, which we don't need
+            continue
+        if message.type != aiohttp.WSMsgType.TEXT:
+            raise Exception(f"ComfyUI websocket closed unexpectedly ({message.type.name})")
+        
+        message = json.loads(message.data)
+        data = message.get("data", {})
+        if data.get("prompt_id") != execution_id:
+            continue
+        
+        if message["type"] == "executing":
+            if data.get("node") is None:
+                return outputs
+            logger.info(f"Executing node {data['node']}")
+        elif message["type"] == "executed":
+            outputs[data["node"]] = data.get("output") or {}
+        elif message["type"] == "progress":
+            logger.info(f"Progress: {data.get('value')}/{data.get('max')}")
+        elif message["type"] == "execution_error":
+            raise Exception(data.get("exception_message", "Unknown error in workflow processing"))
+
+# Queue the workflow and wait on the websocket until it has been executed
+async def run_workflow(session, workflow_data):
+    client_id = str(uuid.uuid4())
+    ws_endpoint = f"ws://127.0.0.1:{COMFYUI_PORT}/ws?clientId={client_id}"
+    api_endpoint = f"http://127.0.0.1:{COMFYUI_PORT}/prompt"
+    
+    # Connect before queueing so no execution messages are missed
+    async with session.ws_connect(ws_endpoint, max_msg_size=0) as ws:
+        try:
+            logger.info("Sending workflow to ComfyUI...")
+            # The workflow is only sent once; extra_pnginfo would embed a second copy
+            # in the request purely for output file metadata
+            async with session.post(
+                api_endpoint,
+                data=dumps_json({
+                    "prompt": workflow_data,
+                    "client_id": client_id
+                }),
+                headers={"Content-Type": "application/json"},
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                if response.status != 200:
+                    error_msg = f"Failed to queue workflow: {await response.text()}"
+                    logger.error(error_msg)
+                    raise Exception(error_msg)
+                
+                execution_id = (await response.json())["prompt_id"]
+            logger.info(f"Workflow queued with ID: {execution_id}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error_msg = f"Error sending workflow to ComfyUI: {str(e)}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
+        
+        logger.info(f"Waiting for results (max {PROCESSING_TIMEOUT}s)...")
+        outputs = await asyncio.wait_for(wait_for_execution(ws, execution_id), timeout=PROCESSING_TIMEOUT)
+    
+    return execution_id, outputs
+
+# Fetch the node outputs of a finished prompt from /history
+async def fetch_history_outputs(session, execution_id):
+    async with session.get(
+        f"http://127.0.0.1:{COMFYUI_PORT}/history/{execution_id}",
+        timeout=aiohttp.ClientTimeout(total=10)
+    ) as response:
+        history = await response.json()
+    
+    if execution_id not in history:
+        raise Exception(f"Execution ID {execution_id} not found in history")
+    
+    execution_data = history[execution_id]
+    if execution_data.get("status", {}).get("status_str") == "error":
+        raise Exception("Unknown error in workflow processing")
+    
+    return execution_data.get("outputs", {})
+
+# Process the workflow and return the first file written by output_node_id under output_kind
+# (e.g. "24"/"videos"), as a path, presigned URL or base64 depending on configuration
+async def process_workflow(workflow_data, output_node_id, output_kind):
+    logger.info("Processing workflow...")
+    
+    # "videos" -> "video", "images" -> "image"
+    field = output_kind[:-1]
+    
+    session = get_client_session()
+    try:
+        execution_id, outputs = await run_workflow(session, workflow_data)
+    except asyncio.TimeoutError:
+        error_msg = f"Timeout waiting for results after {PROCESSING_TIMEOUT} seconds"
+        logger.error(error_msg)
+        return {"status": "error", "message": error_msg}
+    except Exception as e:
+        error_msg = f"Workflow processing failed: {str(e)}"
+        logger.error(error_msg)
+        return {"status": "error", "message": error_msg}
+    
+    logger.info("Workflow processing completed successfully")
+    
+    # The output is normally reported over the websocket; only fall back to /history
+    # if it was missed (e.g. the result was served from ComfyUI's cache)
+    if output_node_id not in outputs:
+        try:
+            outputs = await fetch_history_outputs(session, execution_id)
+        except Exception as e:
+            error_msg = f"Error fetching workflow results: {str(e)}"
+            logger.error(error_msg)
+            return {"status": "error", "message": error_msg}
+    
+    # Find the output file
+    node_output = outputs.get(output_node_id)
+    if node_output and output_kind in node_output:
+        output_data = node_output[output_kind][0]
+        output_path = f"{OUTPUT_DIR}/{output_data['filename']}"
+        logger.info(f"Found output {field}: {output_path}")
+        
+        if RETURN_PATH_ONLY:
+            return {
+                "status": "success",
+                f"{field}_path": output_path,
+                "execution_id": execution_id
+            }
+        
+        # Upload to the output bucket if configured, otherwise return base64 encoded output
+        try:
+            if S3_CLIENT:
+                content_type = mimetypes.guess_type(output_path)[0] or "application/octet-stream"
+                output_url = await asyncio.to_thread(upload_output, output_path, f"{execution_id}/{output_data['filename']}", content_type)
+                return {
+                    "status": "success",
+                    f"{field}_url": output_url,
+                    "execution_id": execution_id
+                }
+            
+            # Encoding large files is CPU-bound, so keep it off the event loop
+            output_base64 = await asyncio.to_thread(encode_file_base64, output_path)
+            
+            return {
+                "status": "success",
+                field: output_base64,
+                "execution_id": execution_id
+            }
+        except Exception as e:
+            error_msg = f"Error returning output {field}: {str(e)}"
+            logger.error(error_msg)
+            return {"status": "error", "message": error_msg}
+    
+    # If we get here, the workflow completed but we couldn't find the output
+    error_msg = f"No output {field} found in results"
+    logger.error(error_msg)
+    return {"status": "error", "message": error_msg}
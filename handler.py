@@ -1,255 +1,146 @@
 import os
 import json
+import copy
 import time
-import base64
+import asyncio
 import runpod
-import subprocess
-import threading
-import requests
 import sys
 import logging
-from io import BytesIO
-from PIL import Image
+from comfy_core import (
+    LOG_LEVEL, start_comfyui, wait_for_comfyui, get_client_session, close_client_session,
+    run_workflow, process_workflow, stage_input_image, remove_input_image
+)
 
 # Configure logging
 logging.basicConfig(
-    level=logging.INFO,
+    level=LOG_LEVEL,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 logger = logging.getLogger("comfyui-handler")
 
 # Configuration
-COMFYUI_PORT = 8188
-MAX_STARTUP_RETRIES = 120
-STARTUP_RETRY_INTERVAL = 5
-MAX_PROCESSING_RETRIES = 600
-PROCESSING_RETRY_INTERVAL = 2
-REQUEST_TIMEOUT = 60
+DEFAULT_WORKFLOW_PATH = "/workspace/workflow.json"
+INPUT_IMAGE_NODE_ID = "58"
+# Node types that may be rewritten to load the staged input image
+INPUT_IMAGE_NODE_TYPES = ("ETN_LoadImageBase64", "LoadImage")
+OUTPUT_NODE_ID = "24"
+OUTPUT_KIND = "videos"
+LOG_VALUE_MAX_LENGTH = 200
+# Run the default workflow once at startup so model loading isn't paid by the first request
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "1").lower() in ("1", "true", "yes")
+# 64x64 white PNG used as the warm-up input image
+WARMUP_IMAGE = "iVBORw0KGgoAAAANSUhEUgAAAEAAAABACAIAAAAlC+aJAAAAS0lEQVR42u3PMQ0AAAwDoPo33UrYvQQckD4XAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAYHLAMpT0sIcNbcEAAAAAElFTkSuQmCC"
 
-# Check required dependencies
-def check_dependencies():
+# Load the default workflow once; requests get a deep copy before it is modified
+def load_default_workflow():
     try:
-        import numpy
-        logger.info(f"NumPy version: {numpy.__version__}")
-        
-        import torch
-        logger.info(f"PyTorch version: {torch.__version__}")
-        logger.info(f"CUDA available: {torch.cuda.is_available()}")
-        if torch.cuda.is_available():
-            logger.info(f"CUDA version: {torch.version.cuda}")
-        
-        import torchaudio
-        logger.info(f"TorchAudio version: {torchaudio.__version__}")
-        
-        # Check FFmpeg
-        try:
-            import imageio_ffmpeg
-            logger.info(f"imageio-ffmpeg version: {imageio_ffmpeg.__version__}")
-            ffmpeg_path = imageio_ffmpeg.get_ffmpeg_exe()
-            logger.info(f"FFmpeg path: {ffmpeg_path}")
-        except ImportError:
-            logger.error("imageio-ffmpeg is not installed!")
-            raise
-        except Exception as e:
-            logger.error(f"Error checking FFmpeg: {str(e)}")
-            raise
-            
-    except ImportError as e:
-        logger.error(f"Missing required dependency: {str(e)}")
-        raise
+        with open(DEFAULT_WORKFLOW_PATH, "r") as f:
+            return json.load(f)
     except Exception as e:
-        logger.error(f"Error checking dependencies: {str(e)}")
-        raise
+        logger.error(f"Error loading default workflow: {str(e)}")
+        return None
 
-# Start ComfyUI as a background process
-def start_comfyui():
-    logger.info("Starting ComfyUI server...")
-    try:
-        # Check dependencies first
-        check_dependencies()
-        
-        process = subprocess.Popen(
-            ["python", "main.py", "--listen", "0.0.0.0", "--port", str(COMFYUI_PORT), "--cuda-device", "0"],
-            cwd="/workspace/ComfyUI",
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        
-        # Log output in separate threads
-        def log_output(pipe, level):
-            for line in pipe:
-                if level == "INFO":
-                    logger.info(f"ComfyUI: {line.strip()}")
-                else:
-                    logger.error(f"ComfyUI: {line.strip()}")
-                    
-        threading.Thread(target=log_output, args=(process.stdout, "INFO"), daemon=True).start()
-        threading.Thread(target=log_output, args=(process.stderr, "ERROR"), daemon=True).start()
-        
-        return process
-    except Exception as e:
-        logger.error(f"Error starting ComfyUI: {str(e)}")
-        raise
+_DEFAULT_WORKFLOW = load_default_workflow()
 
-# Wait for ComfyUI to be ready
-def wait_for_comfyui():
-    logger.info(f"Waiting for ComfyUI server to be ready (max {MAX_STARTUP_RETRIES * STARTUP_RETRY_INTERVAL}s)...")
-    
-    for retry in range(MAX_STARTUP_RETRIES):
-        try:
-            response = requests.get(f"http://127.0.0.1:{COMFYUI_PORT}/system_stats", timeout=REQUEST_TIMEOUT)
-            if response.status_code == 200:
-                logger.info("ComfyUI server is ready!")
-                return True
-            else:
-                logger.warning(f"ComfyUI returned status code {response.status_code}, retrying...")
-        except requests.exceptions.ConnectionError:
-            logger.info(f"Waiting for ComfyUI to start (attempt {retry+1}/{MAX_STARTUP_RETRIES})...")
-        except requests.exceptions.Timeout:
-            logger.warning(f"Timeout while checking ComfyUI status (attempt {retry+1}/{MAX_STARTUP_RETRIES})")
-        except Exception as e:
-            logger.warning(f"Error checking ComfyUI status: {str(e)}")
-        
-        time.sleep(STARTUP_RETRY_INTERVAL)
-    
-    raise Exception(f"ComfyUI server failed to start after {MAX_STARTUP_RETRIES * STARTUP_RETRY_INTERVAL} seconds")
+# Check that the workflow has an image loader node we know how to rewrite
+def has_input_image_node(workflow_data):
+    node = workflow_data.get(INPUT_IMAGE_NODE_ID)
+    return isinstance(node, dict) and node.get("class_type") in INPUT_IMAGE_NODE_TYPES
 
-# Process the workflow
-def process_workflow(workflow_data):
-    logger.info("Processing workflow...")
-    
-    # Queue the workflow
-    api_endpoint = f"http://127.0.0.1:{COMFYUI_PORT}/prompt"
-    
+# Point the input image node at a file staged in ComfyUI's input directory
+def set_input_image(workflow_data, image_filename):
+    workflow_data[INPUT_IMAGE_NODE_ID]["class_type"] = "LoadImage"
+    workflow_data[INPUT_IMAGE_NODE_ID]["inputs"] = {"image": image_filename}
+
+# Run the warm-up workflow, closing the shared session before asyncio.run tears down its loop
+async def run_warm_up_workflow(workflow_data):
     try:
-        logger.info("Sending workflow to ComfyUI...")
-        response = requests.post(
-            api_endpoint,
-            json={
-                "prompt": workflow_data,
-                "extra_data": {
-                    "extra_pnginfo": {
-                        "workflow": workflow_data
-                    }
-                }
-            },
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            error_msg = f"Failed to queue workflow: {response.text}"
-            logger.error(error_msg)
-            raise Exception(error_msg)
-        
-        execution_id = response.json()["prompt_id"]
-        logger.info(f"Workflow queued with ID: {execution_id}")
-    except requests.exceptions.RequestException as e:
-        error_msg = f"Error sending workflow to ComfyUI: {str(e)}"
-        logger.error(error_msg)
-        raise Exception(error_msg)
-    
-    # Poll for results
-    logger.info(f"Waiting for results (max {MAX_PROCESSING_RETRIES * PROCESSING_RETRY_INTERVAL}s)...")
+        return await run_workflow(get_client_session(), workflow_data)
+    finally:
+        await close_client_session()
+
+# Run the default workflow once with a dummy image and a single sampling step,
+# so checkpoints are loaded onto the GPU before the first real request. Video
+# outputs are not saved, so nothing is left behind in the shared output directory
+def warm_up():
+    if _DEFAULT_WORKFLOW is None:
+        logger.warning("Skipping warm-up, default workflow is not available")
+        return
     
-    for retry in range(MAX_PROCESSING_RETRIES):
-        try:
-            response = requests.get(f"http://127.0.0.1:{COMFYUI_PORT}/history", timeout=10)
-            history = response.json()
-            
-            if execution_id in history:
-                execution_data = history[execution_id]
-                
-                # Check if processing is complete
-                if "outputs" in execution_data and execution_data.get("status", {}).get("status") == "success":
-                    logger.info("Workflow processing completed successfully")
-                    
-                    # Find the output video (node 24)
-                    for node_id, node_output in execution_data["outputs"].items():
-                        if node_id == "24":
-                            if "videos" in node_output:
-                                video_data = node_output["videos"][0]
-                                video_path = f"/workspace/ComfyUI/output/{video_data['filename']}"
-                                logger.info(f"Found output video: {video_path}")
-                                
-                                # Return base64 encoded video
-                                try:
-                                    with open(video_path, "rb") as video_file:
-                                        video_base64 = base64.b64encode(video_file.read()).decode("utf-8")
-                                    
-                                    return {
-                                        "status": "success",
-                                        "video": video_base64,
-                                        "execution_id": execution_id
-                                    }
-                                except Exception as e:
-                                    error_msg = f"Error reading output video: {str(e)}"
-                                    logger.error(error_msg)
-                                    return {"status": "error", "message": error_msg}
-                    
-                    # If we get here, the workflow completed but we couldn't find the video
-                    error_msg = "No output video found in results"
-                    logger.error(error_msg)
-                    return {"status": "error", "message": error_msg}
-                
-                # Check if there was an error
-                if execution_data.get("status", {}).get("status") == "error":
-                    error_msg = execution_data.get("status", {}).get("message", "Unknown error in workflow processing")
-                    logger.error(f"Workflow processing failed: {error_msg}")
-                    return {"status": "error", "message": error_msg}
-                
-                # Still processing
-                status = execution_data.get("status", {}).get("status", "unknown")
-                logger.info(f"Still processing (status: {status}), retrying... ({retry+1}/{MAX_PROCESSING_RETRIES})")
-            else:
-                logger.info(f"Execution ID not found in history yet, retrying... ({retry+1}/{MAX_PROCESSING_RETRIES})")
-        
-        except Exception as e:
-            logger.warning(f"Error checking workflow status: {str(e)}")
-        
-        time.sleep(PROCESSING_RETRY_INTERVAL)
+    logger.info("Warming up ComfyUI with the default workflow...")
+    start_time = time.monotonic()
+    workflow_data = copy.deepcopy(_DEFAULT_WORKFLOW)
+    for node in workflow_data.values():
+        if node.get("class_type") == "KSampler":
+            node["inputs"]["steps"] = 1
+        elif node.get("class_type") == "VHS_VideoCombine":
+            node["inputs"]["save_output"] = False
     
-    error_msg = f"Timeout waiting for results after {MAX_PROCESSING_RETRIES * PROCESSING_RETRY_INTERVAL} seconds"
-    logger.error(error_msg)
-    return {"status": "error", "message": error_msg}
+    image_filename = None
+    try:
+        image_filename = stage_input_image(WARMUP_IMAGE)
+        set_input_image(workflow_data, image_filename)
+        asyncio.run(run_warm_up_workflow(workflow_data))
+        logger.info(f"Warm-up completed in {time.monotonic() - start_time:.1f}s")
+    except Exception as e:
+        logger.warning(f"Warm-up failed: {str(e)}")
+    finally:
+        if image_filename:
+            remove_input_image(image_filename)
+
+# Summarize the job input for logging without serializing large values such as base64 images
+def summarize_input(job_input):
+    summary = {}
+    for key, value in job_input.items():
+        if isinstance(value, str) and len(value) > LOG_VALUE_MAX_LENGTH:
+            summary[key] = f"{value[:LOG_VALUE_MAX_LENGTH]}... ({len(value)} chars)"
+        elif isinstance(value, (dict, list)):
+            summary[key] = f"<{len(value)} entries>"
+        else:
+            summary[key] = value
+    return summary
 
 # Handler function for RunPod
-def handler(event):
+async def handler(event):
     try:
-        logger.info(f"Received event: {json.dumps(event.get('input', {}))[:1000]}...")
+        logger.info(f"Received event: {summarize_input(event.get('input', {}))}")
         
         # Get the workflow and image from the input
         workflow_data = event.get("input", {}).get("workflow")
         input_image = event.get("input", {}).get("image", "")
         
-        # If workflow is not provided, use the default one
-        if not workflow_data:
-            try:
-                with open("/workspace/workflow.json", "r") as f:
-                    workflow_data = json.load(f)
-                logger.info("Using default workflow from workflow.json")
-            except Exception as e:
-                error_msg = f"Error loading default workflow: {str(e)}"
-                logger.error(error_msg)
-                return {"status": "error", "message": error_msg}
+        if not input_image:
+            error_msg = "No input image provided"
+            logger.error(error_msg)
+            return {"status": "error", "message": error_msg}
         
-        # Set the input image in the workflow
-        if input_image:
-            if "58" in workflow_data:
-                logger.info("Setting input image in node 58")
-                workflow_data["58"]["inputs"]["image"] = input_image
-            else:
-                error_msg = "Node 58 (ETN_LoadImageBase64) not found in workflow"
+        # If workflow is not provided, use the default one (validated at startup)
+        if not workflow_data:
+            if _DEFAULT_WORKFLOW is None:
+                error_msg = f"Default workflow could not be loaded from {DEFAULT_WORKFLOW_PATH}"
                 logger.error(error_msg)
                 return {"status": "error", "message": error_msg}
-        else:
-            error_msg = "No input image provided"
+            workflow_data = copy.deepcopy(_DEFAULT_WORKFLOW)
+            logger.info("Using default workflow from workflow.json")
+        elif not has_input_image_node(workflow_data):
+            error_msg = f"Node {INPUT_IMAGE_NODE_ID} (ETN_LoadImageBase64 or LoadImage) not found in workflow"
             logger.error(error_msg)
             return {"status": "error", "message": error_msg}
         
-        # Process the workflow
-        result = process_workflow(workflow_data)
+        # Write the input image to ComfyUI's input directory and load it from disk,
+        # rather than inlining the base64 data in the workflow JSON
+        image_filename = None
+        try:
+            image_filename = await asyncio.to_thread(stage_input_image, input_image)
+            logger.info(f"Setting input image {image_filename} in node {INPUT_IMAGE_NODE_ID}")
+            set_input_image(workflow_data, image_filename)
+            
+            # Process the workflow
+            result = await process_workflow(workflow_data, OUTPUT_NODE_ID, OUTPUT_KIND)
+        finally:
+            if image_filename:
+                remove_input_image(image_filename)
         logger.info(f"Processing completed with status: {result.get('status')}")
         return result
     
@@ -261,15 +152,23 @@ def handler(event):
 # Main function
 if __name__ == "__main__":
     try:
+        # Fail at startup rather than per request if the default workflow has drifted
+        if _DEFAULT_WORKFLOW is not None and not has_input_image_node(_DEFAULT_WORKFLOW):
+            raise Exception(f"Default workflow is missing node {INPUT_IMAGE_NODE_ID} (ETN_LoadImageBase64 or LoadImage)")
+        
         # Start ComfyUI
         comfyui_process = start_comfyui()
         
         # Wait for ComfyUI to be ready
         wait_for_comfyui()
         
+        # Load models before accepting jobs
+        if WARMUP_ON_START:
+            warm_up()
+        
         # Start the RunPod serverless handler
         logger.info("Starting RunPod handler...")
-        runpod.serverless.start({"handler": handler})
+        runpod.serverless.start({"handler": handler, "return_aggregate_stream": True})
     except Exception as e:
         logger.error(f"Fatal error: {str(e)}")
         sys.exit(1)
\ No newline at end of file